@@ -1,98 +1,405 @@
 import os
+import time
 import uuid
+import base64
+import secrets
+import functools
 import sqlite3
-from datetime import datetime, timedelta
-from flask import Flask, request, redirect, render_template, url_for, flash, send_from_directory, g
+import threading
+from datetime import datetime
+from urllib.parse import quote
+from flask import Flask, Request, Response, request, redirect, render_template, url_for, flash, g, session
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import TooManyRequests
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_wtf import FlaskForm
 from wtforms import FileField, SelectField, PasswordField, SubmitField
 from wtforms.validators import DataRequired
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
+from jinja2 import FileSystemBytecodeCache
 from flask import send_file, safe_join, current_app
 from flask_limiter.util import get_remote_address
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
+from apscheduler.schedulers.blocking import BlockingScheduler
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+DATABASE = '/app/messages.db'
+UPLOAD_FOLDER = '/app/data'
+ALLOWED_EXTENSIONS = frozenset({'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar'})
+UPLOAD_BUFFER_SIZE = 1 << 20  # Taille du tampon d'écriture des fichiers téléversés (1 Mo)
+CHUNK_SIZE = 1 << 20  # Taille des blocs chiffrés/déchiffrés (1 Mo)
+NONCE_SIZE = 12
+TAG_SIZE = 16
+PART_SUFFIX = '.part'  # Téléversement en cours, pas encore enregistré en base
+STALE_PART_AGE = 3600  # Âge (s) au-delà duquel un .part abandonné est purgé
+
+# Chiffrement des fichiers au repos ; désactivé, les téléchargements sont servis
+# en zéro-copie (sendfile ou X-Accel-Redirect derrière nginx)
+ENCRYPT_FILES = os.environ.get('ENCRYPT_FILES', 'true').lower() == 'true'
+X_ACCEL_REDIRECT = os.environ.get('X_ACCEL_REDIRECT', '')
+
+# Clé AES-256 (32 octets encodés en base64 url-safe, cf. .env). Elle doit être
+# partagée par tous les workers, sinon un worker ne peut pas déchiffrer les
+# fichiers téléversés via un autre : pas de clé générée au démarrage.
+ENCRYPTION_KEY = base64.urlsafe_b64decode(os.environ['ENCRYPTION_KEY']) if os.environ.get('ENCRYPTION_KEY') else None
+if ENCRYPT_FILES and ENCRYPTION_KEY is None:
+    raise RuntimeError("La variable d'environnement ENCRYPTION_KEY doit être définie.")
+if ENCRYPTION_KEY is not None and len(ENCRYPTION_KEY) != 32:
+    raise RuntimeError("ENCRYPTION_KEY doit encoder exactement 32 octets (AES-256).")
+
+class StreamingRequest(Request):
+    """Écrit les fichiers téléversés directement dans le dossier de destination.
+
+    Werkzeug met par défaut chaque fichier dans un SpooledTemporaryFile avant
+    que la vue ne le recopie avec ``file.save()``. Ici chaque fichier envoyé à
+    ``upload_file`` est écrit au fil de l'eau dans ``UPLOAD_FOLDER/<file_id>.part`` :
+    la mémoire reste constante quelle que soit la taille du fichier et la
+    copie est supprimée. La vue renomme le champ ``file`` une fois la ligne
+    insérée en base ; tout autre ``.part`` est supprimé en fin de requête.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'upload_file':
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        part_path = os.path.join(UPLOAD_FOLDER, uuid.uuid4().hex + PART_SUFFIX)
+        self.__dict__.setdefault('upload_parts', []).append(part_path)
+        return open(part_path, 'w+b', buffering=UPLOAD_BUFFER_SIZE)
 
 # Configuration de l'application
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey')
 csrf = CSRFProtect(app)
 
-# Configuration de Redis
-redis_client = Redis(host='redis', port=6379)
+# Configuration de Redis : un pool de connexions persistantes partagé par
+# l'application et Flask-Limiter (attente plutôt qu'erreur si le pool est plein)
+redis_pool = BlockingConnectionPool(host='redis', port=6379, max_connections=64, socket_keepalive=True)
+redis_client = Redis(connection_pool=redis_pool)
 
 # Limiter les tentatives de connexion pour éviter les attaques par force brute
 limiter = Limiter(
     get_remote_address,
     app=app,
     storage_uri='redis://redis:6379',
-    default_limits=["200 per day", "50 per hour"]
+    storage_options={'connection_pool': redis_pool},
+    strategy='fixed-window'
 )
 
-DATABASE = '/app/messages.db'
-UPLOAD_FOLDER = '/app/data'
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar'}
+# Limites par adresse IP et par route, comme les default_limits de
+# Flask-Limiter : (fenêtre en secondes, nombre de requêtes)
+RATE_LIMITS = [(86400, 200), (3600, 50)]
+
+# Incrémente tous les compteurs en un seul aller-retour Redis. Renvoie le délai
+# avant réinitialisation de la première fenêtre dépassée, ou 0.
+RATE_LIMIT_LUA = """
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local count = redis.call('INCR', key)
+    if count == 1 then
+        redis.call('EXPIRE', key, ARGV[2 * i - 1])
+    end
+    if retry_after == 0 and count > tonumber(ARGV[2 * i]) then
+        retry_after = redis.call('TTL', key)
+    end
+end
+return retry_after
+"""
+rate_limit_script = redis_client.register_script(RATE_LIMIT_LUA)
+
+def check_rate_limit():
+    if request.endpoint == 'static':
+        return
+    address = get_remote_address()
+    keys = [f'rl:{window}:{request.endpoint}:{address}' for window, _ in RATE_LIMITS]
+    args = [value for limit in RATE_LIMITS for value in limit]
+    retry_after = rate_limit_script(keys=keys, args=args)
+    if retry_after:
+        raise TooManyRequests(retry_after=retry_after)
+
+# Premier hook exécuté : une requête hors limite est refusée avant que
+# CSRFProtect n'accède à request.form, donc avant la lecture du corps
+app.before_request_funcs.setdefault(None, []).insert(0, check_rate_limit)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_FILE_SIZE', '10')) * 1024 * 1024
+
+# Les templates compilés sont partagés entre les workers via le disque. Le
+# dossier par défaut de Jinja est propre à l'utilisateur (0700, propriétaire
+# vérifié) : personne d'autre ne peut y déposer de bytecode.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 class PasswordForm(FlaskForm):
     password = PasswordField('Mot de passe', validators=[DataRequired()])
     submit = SubmitField('Soumettre')
 
 # Définition du formulaire WTForms
+EXPIRY_CHOICES = [('3h', '3 heures'), ('1d', '1 jour'), ('1w', '1 semaine'), ('1m', '1 mois')]
+MAX_DOWNLOADS_CHOICES = [('1', '1'), ('5', '5'), ('10', '10'), ('unlimited', 'Illimité')]
+
 class FileUploadForm(FlaskForm):
     file = FileField('Choisissez un fichier', validators=[DataRequired()])
-    expiry = SelectField('Durée de validité', choices=[('3h', '3 heures'), ('1d', '1 jour'), ('1w', '1 semaine'), ('1m', '1 mois')])
-    max_downloads = SelectField('Nombre maximal de téléchargements', choices=[('1', '1'), ('5', '5'), ('10', '10'), ('unlimited', 'Illimité')], validators=[DataRequired()])
+    expiry = SelectField('Durée de validité', choices=EXPIRY_CHOICES)
+    max_downloads = SelectField('Nombre maximal de téléchargements', choices=MAX_DOWNLOADS_CHOICES, validators=[DataRequired()])
     password = PasswordField('Mot de passe (optionnel)')
     submit = SubmitField('Téléverser')
 
+# Fichiers : cache du noyau, chiffrement et téléchargement
+def fadvise(f, advice):
+    """Transmet un conseil de cache au noyau pour tout le fichier ``f``.
+
+    ``advice`` est le nom de la constante (ex. ``'POSIX_FADV_SEQUENTIAL'``) ;
+    sans effet sur les plateformes qui ne proposent pas ``posix_fadvise``.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+
+def drop_from_page_cache(f):
+    """Écrit ``f`` sur disque puis retire ses pages du cache du noyau.
+
+    ``POSIX_FADV_DONTNEED`` ignore les pages encore sales : ``fdatasync``
+    est nécessaire pour que le conseil s'applique à tout le fichier.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        f.flush()
+        os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def encrypt_file(path):
+    """Chiffre un fichier en AES-GCM par blocs de ``CHUNK_SIZE``.
+
+    Format sur disque : nonce (12 octets) | texte chiffré | tag (16 octets).
+    Le résultat est écrit dans un fichier temporaire puis renommé, pour ne
+    jamais laisser un fichier à moitié chiffré en cas d'interruption.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    encryptor = Cipher(algorithms.AES(ENCRYPTION_KEY), modes.GCM(nonce)).encryptor()
+    tmp_path = path + '.tmp'
+    try:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            fadvise(src, 'POSIX_FADV_SEQUENTIAL')
+            dst.write(nonce)
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(encryptor.update(chunk))
+            dst.write(encryptor.finalize())
+            dst.write(encryptor.tag)
+            # Un fichier téléversé n'est relu qu'au téléchargement : inutile
+            # d'occuper le cache de pages d'ici là
+            drop_from_page_cache(dst)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Ne jamais laisser de fichier partiellement chiffré derrière soi
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def ciphertext_chunks(src):
+    """Renvoie le déchiffreur GCM du fichier ouvert ``src`` et ses blocs chiffrés."""
+    src.seek(0)
+    nonce = src.read(NONCE_SIZE)
+    src.seek(-TAG_SIZE, os.SEEK_END)
+    remaining = src.tell() - NONCE_SIZE
+    tag = src.read(TAG_SIZE)
+    src.seek(NONCE_SIZE)
+    decryptor = Cipher(algorithms.AES(ENCRYPTION_KEY), modes.GCM(nonce, tag)).decryptor()
+
+    def chunks(remaining):
+        while remaining > 0:
+            chunk = src.read(min(CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            yield chunk
+    return decryptor, chunks(remaining)
+
+def verify_file(src):
+    """Vérifie le tag GCM du fichier ouvert ``src`` ; lève ``InvalidTag`` sinon.
+
+    Le tag n'est contrôlé qu'à la fin du déchiffrement : sans cette passe
+    préalable, tout le texte clair d'un fichier altéré serait déjà envoyé
+    au client quand l'erreur survient.
+    """
+    decryptor, chunks = ciphertext_chunks(src)
+    for chunk in chunks:
+        decryptor.update(chunk)
+    decryptor.finalize()
+
+def decrypt_chunks(src):
+    """Générateur qui déchiffre le fichier ouvert ``src`` bloc par bloc.
+
+    Le texte clair n'est jamais écrit sur disque : chaque bloc est envoyé au
+    client dès qu'il est déchiffré. Le fichier est ouvert et son tag vérifié
+    (``verify_file``) par l'appelant, avant l'envoi des en-têtes : une purge
+    survenant pendant le transfert ne peut plus le tronquer.
+    """
+    decryptor, chunks = ciphertext_chunks(src)
+    for chunk in chunks:
+        yield decryptor.update(chunk)
+    yield decryptor.finalize()
+
+def content_disposition(filename):
+    """En-tête ``Content-Disposition`` conservant le nom d'origine (RFC 5987).
+
+    Le nom est stocké tel quel en base ; il n'est assaini qu'ici, pour le
+    paramètre ``filename`` ASCII de repli.
+    """
+    fallback = secure_filename(filename) or 'fichier'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
 # Fonctions de base de données
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+# Une connexion SQLite persistante par thread de worker, ouverte au premier usage
+_local = threading.local()
 
 def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE, timeout=10, check_same_thread=False)
-    return g.db
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(DATABASE, timeout=10, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA cache_size=-20000')
+        db.execute('PRAGMA mmap_size=268435456')
+        db.execute('PRAGMA temp_store=MEMORY')
+        _local.db = db
+    return db
+
+# Version du schéma, enregistrée dans PRAGMA user_version
+SCHEMA_VERSION = 1
+
+FILES_COLUMNS = '''
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    original_filename TEXT,
+    expiry INTEGER,
+    views INTEGER DEFAULT 0,
+    max_downloads INTEGER,
+    password TEXT,
+    encrypted INTEGER DEFAULT 1
+'''
 
 def init_db():
     with sqlite3.connect(DATABASE) as conn:
+        # Le mode WAL est persistant : il est enregistré dans le fichier de la base
+        conn.execute('PRAGMA journal_mode=WAL')
         conn.execute('DROP TABLE IF EXISTS files')
-        conn.execute('''
-            CREATE TABLE files (
-                id TEXT PRIMARY KEY,
-                filename TEXT,
-                original_filename TEXT,
-                expiry TIMESTAMP,
-                views INTEGER DEFAULT 0,
-                max_downloads TEXT,
-                password TEXT
-            )
-        ''')
+        conn.execute(f'CREATE TABLE files ({FILES_COLUMNS})')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_files_expiry ON files(expiry)')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+def migrate_db():
+    """Met à jour une base existante jusqu'à ``SCHEMA_VERSION``.
+
+    Lancé à chaque démarrage par entrypoint.sh ; sans effet sur une base à
+    jour. Tout se fait dans une seule transaction : une migration interrompue
+    laisse la base dans son état d'origine.
+    """
+    conn = sqlite3.connect(DATABASE, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            # Schéma d'origine : expiry en texte (datetime de l'heure du
+            # conteneur, UTC), max_downloads en texte ('unlimited' ou un
+            # nombre) et fichiers stockés en clair. SQLite ne sait pas changer
+            # le type d'une colonne : la table est recréée.
+            conn.execute(f'CREATE TABLE files_new ({FILES_COLUMNS})')
+            conn.execute('''
+                INSERT INTO files_new (id, filename, original_filename, expiry, views, max_downloads, password, encrypted)
+                SELECT id, filename, original_filename,
+                       COALESCE(CAST(strftime('%s', expiry) AS INTEGER), 0),
+                       views,
+                       CASE WHEN max_downloads = 'unlimited' THEN NULL ELSE CAST(max_downloads AS INTEGER) END,
+                       password, 0
+                FROM files
+            ''')
+            conn.execute('DROP TABLE files')
+            conn.execute('ALTER TABLE files_new RENAME TO files')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_files_expiry ON files(expiry)')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    finally:
+        # Sans COMMIT, la fermeture annule la transaction
+        conn.close()
+
+# Fichiers à supprimer : expirés, ou ayant atteint leur nombre maximal de téléchargements
+PURGE_CONDITION = "expiry < ? OR (max_downloads IS NOT NULL AND views >= max_downloads)"
+
+def purge_files():
+    """Supprime par lot les fichiers qui ne peuvent plus être téléchargés."""
+    rows = get_db().execute('DELETE FROM files WHERE ' + PURGE_CONDITION + ' RETURNING id',
+                            (int(time.time()),)).fetchall()
+    for (file_id,) in rows:
+        try:
+            os.remove(os.path.join(UPLOAD_FOLDER, file_id))
+        except FileNotFoundError:
+            pass
+    # Téléversements abandonnés sans passer par la fin de requête (worker tué)
+    stale = time.time() - STALE_PART_AGE
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if PART_SUFFIX in entry.name and entry.stat().st_mtime < stale:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+def vacuum_db():
+    get_db().execute('VACUUM')
+
+def run_scheduler():
+    """Purge toutes les 5 minutes et VACUUM chaque nuit.
+
+    À lancer dans un unique processus dédié (service ``scheduler`` de
+    docker-compose), et non dans chaque worker gunicorn.
+    """
+    scheduler = BlockingScheduler()
+    scheduler.add_job(purge_files, 'interval', minutes=5)
+    scheduler.add_job(vacuum_db, 'cron', hour=3)
+    scheduler.start()
 
 @app.before_request
 def before_request():
     g.db = get_db()
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, 'db', None)
-    if db is not None:
-        db.close()
+@app.teardown_request
+def remove_upload_parts(exception):
+    # Formulaire refusé (CSRF, limite, validation), client déconnecté ou
+    # erreur : le .part n'a pas été renommé par upload_file, on le supprime
+    for part_path in getattr(request, 'upload_parts', ()):
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
 
-def get_expiry_time(expiry_option):
-    if expiry_option == '3h':
-        return datetime.now() + timedelta(hours=3)
-    elif expiry_option == '1d':
-        return datetime.now() + timedelta(days=1)
-    elif expiry_option == '1w':
-        return datetime.now() + timedelta(weeks=1)
-    elif expiry_option == '1m':
-        return datetime.now() + timedelta(days=30)
-    return None
+# Durée pendant laquelle un mot de passe vérifié reste valable pour la session
+PASSWORD_OK_TTL = 300
+
+def password_verified(file_id):
+    # Évite de recalculer le hash PBKDF2 (~100 ms) à chaque téléchargement
+    token = session.get('token')
+    return token is not None and redis_client.exists(f'pwok:{file_id}:{token}') == 1
+
+def mark_password_verified(file_id):
+    token = session.setdefault('token', secrets.token_hex(16))
+    redis_client.setex(f'pwok:{file_id}:{token}', PASSWORD_OK_TTL, '1')
 
+# Durées de validité proposées, en secondes
+EXPIRY_DURATIONS = {'3h': 3 * 3600, '1d': 86400, '1w': 7 * 86400, '1m': 30 * 86400}
+
+def get_expiry_time(expiry_option):
+    # Date d'expiration en secondes depuis l'epoch
+    duration = EXPIRY_DURATIONS.get(expiry_option)
+    if duration is None:
+        return None
+    return int(time.time()) + duration
+
+# Les variables d'environnement ne changent pas après le démarrage
+@functools.lru_cache(maxsize=1)
 def get_settings():
     return {
         'software_name': os.environ.get('SOFTWARE_NAME', 'FileShareApp'),
@@ -111,96 +418,174 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     file = request.files['file']
-    if file and allowed_file(file.filename):
-        file_id = str(uuid.uuid4())
-        original_filename = file.filename
-        expiry_option = request.form['expiry']
-        max_downloads = request.form['max_downloads']
-        password = request.form['password']
-
-        expiry_time = get_expiry_time(expiry_option)
-        hashed_password = generate_password_hash(password) if password else None
+    # Le fichier a déjà été écrit sur disque pendant l'analyse du formulaire
+    part_path = file.stream.name
+    with file.stream:
+        if not (file and allowed_file(file.filename)):
+            return {"success": False, "message": "No file selected or file type is not allowed"}
+
+        expiry_option = request.form.get('expiry')
+        max_downloads_option = request.form.get('max_downloads')
+        if expiry_option not in dict(EXPIRY_CHOICES) or max_downloads_option not in dict(MAX_DOWNLOADS_CHOICES):
+            return {"success": False, "message": "Invalid expiry or maximum number of downloads"}
+
+        # Seulement pour un fichier accepté : un refus est supprimé en fin de
+        # requête. Chiffré, le fichier est de toute façon relu aussitôt.
+        if not ENCRYPT_FILES:
+            drop_from_page_cache(file.stream)
+
+    file_id = os.path.basename(part_path)[:-len(PART_SUFFIX)]
+    original_filename = file.filename
+    # NULL en base signifie « illimité »
+    max_downloads = None if max_downloads_option == 'unlimited' else int(max_downloads_option)
+    password = request.form.get('password')
+
+    expiry_time = get_expiry_time(expiry_option)
+    hashed_password = generate_password_hash(password) if password else None
+
+    if ENCRYPT_FILES:
+        encrypt_file(part_path)
 
-        # Créer le dossier de téléchargement s'il n'existe pas
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-        file.save(file_path)
+    with g.db:
+        g.db.execute('INSERT INTO files (id, filename, original_filename, expiry, max_downloads, password, encrypted) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (file_id, file_id, original_filename, expiry_time, max_downloads, hashed_password, int(ENCRYPT_FILES)))
+        g.db.commit()
 
-        with g.db:
-            g.db.execute('INSERT INTO files (id, filename, original_filename, expiry, max_downloads, password) VALUES (?, ?, ?, ?, ?, ?)',
-                         (file_id, file_id, original_filename, expiry_time, max_downloads, hashed_password))
-            g.db.commit()
+    # Le fichier ne prend son nom définitif qu'une fois enregistré en base
+    os.replace(part_path, os.path.join(UPLOAD_FOLDER, file_id))
 
-        link = url_for('download_file', file_id=file_id, _external=True)
-        return {"success": True, "link": link}
-    else:
-        return {"success": False, "message": "No file selected or file type is not allowed"}
+    link = url_for('download_file', file_id=file_id, _external=True)
+    return {"success": True, "link": link}
 
 @app.route('/download/<file_id>', methods=['GET', 'POST'])
+@limiter.limit("10 per minute", methods=['POST'], deduct_when=lambda response: response.status_code == 403)
 def download_file(file_id):
     form = PasswordForm()
-    with g.db:
-        cur = g.db.execute('SELECT filename, original_filename, expiry, views, max_downloads, password FROM files WHERE id = ?', (file_id,))
-        row = cur.fetchone()
-
-        if row:
-            filename, original_filename, expiry, views, max_downloads, hashed_password = row
-            expiry_time = datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S.%f')
-
-            if datetime.now() > expiry_time:
-                g.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
-                flash("Le fichier a expiré.")
-                return redirect(url_for('file_expired'))
-
-            if max_downloads != 'unlimited':
-                remaining_downloads = int(max_downloads) - views
-                if remaining_downloads <= 0:
-                    g.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
-                    flash("Le fichier a atteint le nombre maximal de téléchargements.")
-                    return redirect(url_for('file_not_found'))
+    # Lecture seule : pas de transaction, en mode WAL la requête ne prend aucun verrou
+    cur = g.db.execute('SELECT filename, original_filename, expiry, views, max_downloads, password FROM files WHERE id = ?', (file_id,))
+    row = cur.fetchone()
+
+    if row:
+        filename, original_filename, expiry, views, max_downloads, hashed_password = row
+
+        if time.time() > expiry:
+            flash("Le fichier a expiré.")
+            return redirect(url_for('file_expired'))
+
+        if max_downloads is not None:
+            remaining_downloads = max_downloads - views
+            if remaining_downloads <= 0:
+                flash("Le fichier a atteint le nombre maximal de téléchargements.")
+                return redirect(url_for('file_not_found'))
+        else:
+            remaining_downloads = 'Illimité'
+
+        if hashed_password and not password_verified(file_id):
+            if form.validate_on_submit() and check_password_hash(hashed_password, form.password.data):
+                mark_password_verified(file_id)
+            elif request.method == 'POST':
+                # Seuls les échecs sont décomptés par la limite de tentatives
+                flash("Mot de passe incorrect.")
+                return render_template('password_required.html', file_id=file_id, form=form, settings=get_settings()), 403
             else:
-                remaining_downloads = 'Illimité'
-
-            if form.validate_on_submit():
-                password = form.password.data
-                if hashed_password and not check_password_hash(hashed_password, password):
-                    flash("Mot de passe incorrect.")
-                    return render_template('password_required.html', file_id=file_id, form=form, settings=get_settings())
-
-            if hashed_password and request.method == 'GET':
                 return render_template('password_required.html', file_id=file_id, form=form, settings=get_settings())
 
-            return render_template('download.html', 
-                                   file_id=file_id, 
-                                   original_filename=original_filename, 
-                                   expiry_time=expiry_time.strftime('%Y-%m-%d %H:%M:%S'), 
-                                   remaining_downloads=remaining_downloads, 
-                                   settings=get_settings())
-        else:
-            flash("Le fichier n'a pas été trouvé.")
-            return redirect(url_for('file_not_found'))
+        return render_template('download.html', 
+                               file_id=file_id, 
+                               original_filename=original_filename, 
+                               expiry_time=datetime.fromtimestamp(expiry).strftime('%Y-%m-%d %H:%M:%S'), 
+                               remaining_downloads=remaining_downloads, 
+                               settings=get_settings())
+    else:
+        flash("Le fichier n'a pas été trouvé.")
+        return redirect(url_for('file_not_found'))
 
 @app.route('/download_direct/<file_id>', methods=['GET'])
 def download_direct(file_id):
-    with g.db:
-        cur = g.db.execute('SELECT original_filename FROM files WHERE id = ?', (file_id,))
-        row = cur.fetchone()
-        if row:
-            original_filename = row[0]
-            g.db.execute('UPDATE files SET views = views + 1 WHERE id = ?', (file_id,))
-            return send_from_directory(app.config['UPLOAD_FOLDER'], file_id, as_attachment=True, attachment_filename=original_filename)
-        else:
+    # Vérification et incrémentation du compteur en une seule requête atomique :
+    # deux téléchargements simultanés ne peuvent pas dépasser max_downloads.
+    # fetchall() termine l'instruction, ce qui libère le verrou d'écriture.
+    # Un fichier protégé n'est servi qu'après vérification du mot de passe, un
+    # fichier chiffré que si la clé est disponible.
+    now = int(time.time())
+    verified = password_verified(file_id)
+    rows = g.db.execute('UPDATE files SET views = views + 1 '
+                        'WHERE id = ? AND expiry > ? AND (max_downloads IS NULL OR views < max_downloads) '
+                        'AND (password IS NULL OR ?) AND (encrypted = 0 OR ?) '
+                        'RETURNING original_filename, encrypted',
+                        (file_id, now, verified, ENCRYPTION_KEY is not None)).fetchall()
+    if not rows:
+        row = g.db.execute('SELECT expiry, password, encrypted FROM files WHERE id = ?', (file_id,)).fetchone()
+        if row is None:
             flash("Le fichier n'a pas été trouvé.")
             return redirect(url_for('file_not_found'))
+        expiry, hashed_password, encrypted = row
+        if expiry <= now:
+            flash("Le fichier a expiré.")
+            return redirect(url_for('file_expired'))
+        if hashed_password and not verified:
+            return redirect(url_for('download_file', file_id=file_id))
+        if encrypted and ENCRYPTION_KEY is None:
+            # Chiffrement désactivé après coup : aucun téléchargement décompté
+            raise RuntimeError("ENCRYPTION_KEY est nécessaire pour déchiffrer les fichiers existants.")
+        flash("Le fichier a atteint le nombre maximal de téléchargements.")
+        return redirect(url_for('file_not_found'))
+
+    original_filename, encrypted = rows[0]
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], file_id)
+    if not encrypted and X_ACCEL_REDIRECT:
+        # nginx lit le fichier et l'envoie lui-même (location internal).
+        # Il ne l'ouvre qu'après cette réponse : si la purge le supprime
+        # entre-temps (dernier téléchargement autorisé), nginx renvoie 404.
+        return Response(mimetype='application/octet-stream',
+                        headers={'X-Accel-Redirect': X_ACCEL_REDIRECT + file_id,
+                                 'Content-Disposition': content_disposition(original_filename)})
+
+    # Ouvert ici et non pendant l'envoi : la ligne peut être purgée dès
+    # l'UPDATE ci-dessus, mais un fichier ouvert reste lisible après unlink
+    try:
+        src = open(file_path, 'rb')
+    except FileNotFoundError:
+        flash("Le fichier n'a pas été trouvé.")
+        return redirect(url_for('file_not_found'))
+    fadvise(src, 'POSIX_FADV_SEQUENTIAL')
+    size = os.fstat(src.fileno()).st_size
+
+    if not encrypted:
+        # send_file passe par wsgi.file_wrapper, soit sendfile(2) sous gunicorn,
+        # sur ce descripteur qui porte le conseil SEQUENTIAL. Pas de réponse
+        # conditionnelle ni partielle : chaque requête décompte un téléchargement.
+        response = send_file(src, as_attachment=True, download_name=original_filename)
+        response.content_length = size
+        response.headers['Content-Disposition'] = content_disposition(original_filename)
+        return response
+
+    try:
+        verify_file(src)
+    except InvalidTag:
+        # Fichier altéré sur disque : ne rien envoyer au client
+        src.close()
+        raise
+    headers = {
+        'Content-Disposition': content_disposition(original_filename),
+        'Content-Length': str(size - NONCE_SIZE - TAG_SIZE)
+    }
+    response = Response(decrypt_chunks(src), mimetype='application/octet-stream', headers=headers)
+    response.call_on_close(src.close)
+    return response
+
+# Pages sans formulaire ni contenu dynamique : rendues une seule fois par worker
+@functools.lru_cache(maxsize=8)
+def render_static_page(template_name):
+    return render_template(template_name, settings=get_settings())
 
 @app.route('/file_not_found')
 def file_not_found():
-    return render_template('file_not_found.html', settings=get_settings())
+    return render_static_page('file_not_found.html')
 
 @app.route('/file_expired')
 def file_expired():
-    return render_template('file_expired.html', settings=get_settings())
+    return render_static_page('file_expired.html')
 
 # Démarrage de l'application
 if __name__ == '__main__':
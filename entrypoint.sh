@@ -14,5 +14,8 @@ if [ ! -f "/app/messages.db" ]; then
     python -c "from app import init_db; init_db()"
 fi
 
+# Mettre à jour le schéma d'une base existante (sans effet si elle est à jour)
+python -c "from app import migrate_db; migrate_db()"
+
 # Start the Flask application
 exec "$@"